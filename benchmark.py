@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import itertools
+import statistics
+import time
+import uuid
+import httpx
+from collections import deque
+
+
+# Every request claims its own client address so the per-IP /auth rate limiter doesn't dominate the
+# numbers; uvicorn trusts X-Forwarded-For from 127.0.0.1 by default
+addresses = (f"10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}" for n in itertools.count(1))
+
+
+async def post(client, path, **kwargs):
+   response = await client.post(path, headers={"X-Forwarded-For": next(addresses)}, **kwargs)
+   response.raise_for_status()
+   return response.json()
+
+
+async def register(client, users):
+   username = str(uuid.uuid4())
+   await post(client, "/register", json={"username": username, "email": f"{username}@example.com"})
+
+
+async def auth(client, users):
+   username, password = users[0]
+   users.rotate()
+   await post(client, "/auth", json={"username": username, "password": password})
+
+
+async def jwks(client, users):
+   response = await client.get("/.well-known/jwks.json")
+   response.raise_for_status()
+
+
+async def generate_key(client, users):
+   await post(client, "/generate-key")
+
+
+WORKLOADS = {
+   "register": [register],
+   "auth": [auth],
+   "jwks": [jwks],
+   "generate-key": [generate_key],
+   "mixed": [register, auth, auth],
+}
+
+
+async def create_users(client, count):
+   users = []
+   for _ in range(count):
+       username = str(uuid.uuid4())
+       body = await post(client, "/register", json={"username": username, "email": f"{username}@example.com"})
+       users.append((username, body["password"]))
+   return users
+
+
+async def run(url, workload, concurrency, total):
+   latencies = []
+   queue = asyncio.Queue()
+   for index in range(total):
+       queue.put_nowait(WORKLOADS[workload][index % len(WORKLOADS[workload])])
+
+   async def worker(client, users):
+       while not queue.empty():
+           request = queue.get_nowait()
+           started = time.perf_counter()
+           await request(client, users)
+           latencies.append(time.perf_counter() - started)
+
+   async with httpx.AsyncClient(base_url=url, timeout=None) as client:
+       # Users to log in as are registered up front so that only the workload itself is timed
+       users = None
+       if auth in WORKLOADS[workload]:
+           users = deque(await create_users(client, concurrency))
+
+       started = time.perf_counter()
+       await asyncio.gather(*(worker(client, users) for _ in range(concurrency)))
+       elapsed = time.perf_counter() - started
+
+   latencies.sort()
+   return {
+       "workload": workload,
+       "requests": total,
+       "concurrency": concurrency,
+       "seconds": round(elapsed, 2),
+       "requests_per_second": round(total / elapsed, 1),
+       "p50_ms": round(statistics.median(latencies) * 1000, 1),
+       "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 1),
+   }
+
+
+def main():
+   parser = argparse.ArgumentParser(description="Load-test a running auth server.")
+   parser.add_argument("--url", default="http://127.0.0.1:8080")
+   parser.add_argument("--workload", choices=WORKLOADS, default="register")
+   parser.add_argument("--concurrency", type=int, default=32)
+   parser.add_argument("--requests", type=int, default=200)
+   args = parser.parse_args()
+   print(asyncio.run(run(args.url, args.workload, args.concurrency, args.requests)))
+
+
+if __name__ == "__main__":
+   main()
+
+# To compare the servers, start each one in turn from an empty directory and run the same workload:
+# uvicorn project2:app --app-dir <repo> --port 8080    (sync def handlers; jwks)
+# uvicorn project3:app --app-dir <repo> --port 8080    (async def handlers with blocking I/O; register, auth, mixed)
+# uvicorn project4:app --app-dir <repo> --port 8080    (all workloads)
+# python benchmark.py --workload mixed --concurrency 32 --requests 200
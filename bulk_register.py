@@ -0,0 +1,54 @@
+import sqlite3
+import sys
+import json
+import asyncio
+import argparse
+from common import (
+   DB_FILE, BULK_BATCH_SIZE, BULK_HASH_WORKERS, BlockingDatabase, create_users_table, create_hash_executor,
+   parse_bulk_record, iter_batches, register_batch
+)
+
+
+def init_db(db_file=DB_FILE):
+   conn = sqlite3.connect(db_file)
+   try:
+       create_users_table(conn.cursor())
+       conn.commit()
+   finally:
+       conn.close()
+
+
+async def import_users(source, database, executor, batch_size, workers):
+   records = (
+       (line_number, record)
+       for line_number, record in enumerate(map(parse_bulk_record, source), start=1)
+       if record is not None
+   )
+   for batch in iter_batches(records, batch_size):
+       for result in await register_batch(batch, database, executor, workers):
+           print(json.dumps(result))
+
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description="Bulk-register users from an NDJSON file.")
+   parser.add_argument("file", help='NDJSON file with one {"username", "email"} object per line, or - for stdin')
+   parser.add_argument("--db", default=DB_FILE)
+   parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+   parser.add_argument("--workers", type=int, default=BULK_HASH_WORKERS)
+   args = parser.parse_args(argv)
+
+   # Only creates the users table if it is missing, so importing into a live server's database is safe
+   init_db(args.db)
+   source = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8")
+   with create_hash_executor(args.workers) as executor:
+       try:
+           asyncio.run(import_users(source, BlockingDatabase(args.db), executor, args.batch_size, args.workers))
+       finally:
+           if source is not sys.stdin:
+               source.close()
+
+
+if __name__ == "__main__":
+   main()
+
+# To bulk-import users: python bulk_register.py users.ndjson > passwords.ndjson
@@ -0,0 +1,435 @@
+import sqlite3
+import uuid
+import time
+import os
+import re
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from collections import defaultdict
+from fastapi import Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from argon2 import PasswordHasher
+
+
+DB_FILE = "totally_not_my_privateKeys.db"
+BULK_BATCH_SIZE = 1000
+BULK_HASH_WORKERS = os.cpu_count() or 1
+SQLITE_MAX_PARAMS = 500
+MAX_LINE_LENGTH = 64 * 1024
+KEY_EXPIRY_TIME = 3600
+DEK_CACHE_SIZE = 1024
+REWRAP_BATCH_SIZE = 500
+REWRAP_PAUSE = 0.1
+REWRAP_INTERVAL = 60
+RATE_LIMIT = 10
+RATE_PERIOD = 1
+MASTER_KEY_VARIABLE = re.compile(r"NOT_MY_KEY(?:_V([0-9]+))?")
+
+
+ph = PasswordHasher()
+rate_limit_tracker = defaultdict(list)
+logger = logging.getLogger(__name__)
+
+# Set from the environment by configure_master_keys() when a server starts
+MASTER_KEYS = {}
+MASTER_KEY_VERSION = 0
+
+
+class RegisterRequest(BaseModel):
+   username: str
+   email: str
+
+
+class AuthRequest(BaseModel):
+   username: str
+   password: str
+
+
+async def rate_limiter(request: Request, call_next):
+   if request.url.path == "/auth":
+       ip = request.client.host
+       now = time.time()
+       rate_limit_tracker[ip] = [ts for ts in rate_limit_tracker[ip] if now - ts < RATE_PERIOD]
+       if len(rate_limit_tracker[ip]) >= RATE_LIMIT:
+           return JSONResponse(status_code=429, content={"detail": "Too Many Requests"})
+       rate_limit_tracker[ip].append(now)
+
+
+   response = await call_next(request)
+   return response
+
+
+def create_users_table(cursor):
+   cursor.execute("""
+       CREATE TABLE IF NOT EXISTS users(
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           username TEXT NOT NULL UNIQUE,
+           password_hash TEXT NOT NULL,
+           email TEXT UNIQUE,
+           date_registered TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+           last_login TIMESTAMP
+       )
+   """)
+
+
+def create_schema(cursor):
+   """Creates any missing tables, keeping the keys and users of earlier runs."""
+   columns = {row[1] for row in cursor.execute("PRAGMA table_info(keys)")}
+   if columns and "wrapped_key" not in columns:
+       # project2's plaintext keys and the first project3 layout have no data keys to unwrap
+       logger.warning("Replacing keys table from an older layout; its keys can't be read with master keys")
+       cursor.execute("DROP TABLE keys")
+   cursor.execute("""
+       CREATE TABLE IF NOT EXISTS keys (
+           kid INTEGER PRIMARY KEY AUTOINCREMENT,
+           private_key BLOB NOT NULL,
+           iv BLOB NOT NULL,
+           wrapped_key BLOB NOT NULL,
+           key_version INTEGER NOT NULL,
+           public_key TEXT NOT NULL,
+           exp INTEGER NOT NULL
+       )
+   """)
+   if "wrapped_key" in columns and "exp" not in columns:
+       # Keys stored before expiry was tracked get the usual lifetime from now
+       cursor.execute("ALTER TABLE keys ADD COLUMN exp INTEGER NOT NULL DEFAULT 0")
+       cursor.execute("UPDATE keys SET exp = ?", (int(time.time()) + KEY_EXPIRY_TIME,))
+   create_users_table(cursor)
+   cursor.execute("""
+       CREATE TABLE IF NOT EXISTS auth_logs(
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           request_ip TEXT NOT NULL,
+           request_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+           user_id INTEGER,
+           FOREIGN KEY(user_id) REFERENCES users(id)
+       )
+   """)
+
+
+def derive_master_key(secret: str):
+   return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"project3 master key").derive(secret.encode())
+
+
+def load_master_keys(environ=os.environ):
+   """Loads every master key version set in the environment.
+
+   NOT_MY_KEY is version 1 and rotated keys are added as NOT_MY_KEY_V2, NOT_MY_KEY_V3, ...;
+   versions don't have to be contiguous, so retired ones can be unset.
+   """
+   secrets = {}
+   for name, secret in environ.items():
+       match = MASTER_KEY_VARIABLE.fullmatch(name)
+       if not match or not secret:
+           continue
+       version = int(match.group(1) or 1)
+       if version < 1:
+           raise RuntimeError(f"{name} is not a valid master key version")
+       if secrets.get(version, secret) != secret:
+           raise RuntimeError("NOT_MY_KEY and NOT_MY_KEY_V1 are both set to different secrets")
+       secrets[version] = secret
+   if not secrets:
+       raise RuntimeError("No master key is set; set NOT_MY_KEY to a secure random secret")
+   return {version: AESGCM(derive_master_key(secret)) for version, secret in secrets.items()}
+
+
+def configure_master_keys(environ=os.environ):
+   global MASTER_KEYS, MASTER_KEY_VERSION
+   MASTER_KEYS = load_master_keys(environ)
+   MASTER_KEY_VERSION = max(MASTER_KEYS)
+   # A version's secret may have changed, so ciphers unwrapped under the old set can't be reused
+   get_data_cipher.cache_clear()
+
+
+def check_master_keys(cursor):
+   """Fails if any stored data key is wrapped by a master key version that isn't configured."""
+   cursor.execute("SELECT DISTINCT key_version FROM keys")
+   missing = sorted(version for (version,) in cursor.fetchall() if version not in MASTER_KEYS)
+   if missing:
+       names = ", ".join(f"NOT_MY_KEY_V{version}" for version in missing)
+       raise RuntimeError(f"Stored keys are wrapped by master key versions that are not configured: {names}")
+
+
+def wrap_data_key(data_key: bytes):
+   nonce = os.urandom(12)
+   version = MASTER_KEY_VERSION
+   wrapped_key = nonce + MASTER_KEYS[version].encrypt(nonce, data_key, str(version).encode())
+   return wrapped_key, version
+
+
+def unwrap_data_key(wrapped_key: bytes, version: int):
+   return MASTER_KEYS[version].decrypt(wrapped_key[:12], wrapped_key[12:], str(version).encode())
+
+
+@lru_cache(maxsize=DEK_CACHE_SIZE)
+def get_data_cipher(wrapped_key: bytes, version: int):
+   # Unwrapping costs a master key decryption, so ciphers for recently used data keys are kept around
+   return AESGCM(unwrap_data_key(wrapped_key, version))
+
+
+def encrypt_data(data: bytes, associated_data: bytes = None):
+   """Encrypts data under a fresh AES-GCM data key, returning the ciphertext, nonce, wrapped key and master key version."""
+   data_key = AESGCM.generate_key(bit_length=256)
+   iv = os.urandom(12)
+   encrypted_data = AESGCM(data_key).encrypt(iv, data, associated_data)
+   wrapped_key, version = wrap_data_key(data_key)
+   return encrypted_data, iv, wrapped_key, version
+
+
+def decrypt_data(encrypted_data: bytes, iv: bytes, wrapped_key: bytes, version: int, associated_data: bytes = None):
+   return get_data_cipher(wrapped_key, version).decrypt(iv, encrypted_data, associated_data)
+
+
+def generate_encrypted_key():
+   """Generates an RSA key pair, returning the encrypted private key columns and the public key PEM."""
+   key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+   private_bytes = key.private_bytes(
+       encoding=serialization.Encoding.PEM,
+       format=serialization.PrivateFormat.PKCS8,
+       encryption_algorithm=serialization.NoEncryption()
+   )
+
+
+   public_bytes = key.public_key().public_bytes(
+       encoding=serialization.Encoding.PEM,
+       format=serialization.PublicFormat.SubjectPublicKeyInfo
+   )
+
+
+   # The public key is bound as associated data so a private key can't be swapped onto another row
+   encrypted_key, iv, wrapped_key, key_version = encrypt_data(private_bytes, public_bytes)
+   return encrypted_key, iv, wrapped_key, key_version, public_bytes.decode('utf-8')
+
+
+def rewrap_batch(cursor, last_kid, batch_size=REWRAP_BATCH_SIZE):
+   """Re-wraps the next batch of data keys held under older master keys with the current one.
+
+   Returns the last kid looked at, or None once there is nothing left, and the number of rows rotated.
+   """
+   # Rows under a newer version than ours belong to an instance that is already on the new config
+   cursor.execute(
+       """
+       SELECT kid, wrapped_key, key_version FROM keys
+       WHERE kid > ? AND key_version < ?
+       ORDER BY kid LIMIT ?
+       """,
+       (last_kid, MASTER_KEY_VERSION, batch_size)
+   )
+   rows = cursor.fetchall()
+   if not rows:
+       return None, 0
+
+   updates = []
+   for kid, wrapped_key, version in rows:
+       if version not in MASTER_KEYS:
+           logger.warning("Key %s is wrapped by master key version %s, which is not configured", kid, version)
+           continue
+       new_wrapped_key, new_version = wrap_data_key(unwrap_data_key(wrapped_key, version))
+       updates.append((new_wrapped_key, new_version, kid, version))
+   if not updates:
+       return rows[-1][0], 0
+
+   # Only the small wrapped key changes; rows re-wrapped concurrently are left untouched
+   cursor.executemany(
+       "UPDATE keys SET wrapped_key = ?, key_version = ? WHERE kid = ? AND key_version = ?",
+       updates
+   )
+   return rows[-1][0], cursor.rowcount
+
+
+def create_hash_executor(workers=BULK_HASH_WORKERS):
+   # Workers are started from a forkserver because fork() is unsafe once the server is running threads
+   start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+   return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method))
+
+
+class BlockingDatabase:
+   """Runs each job on its own short-lived sqlite3 connection in a worker thread.
+
+   It has the same read/write interface as project4's AsyncDatabase, so register_batch works with either.
+   """
+
+   def __init__(self, path=DB_FILE):
+       self.path = path
+
+   def run(self, fn, args, write):
+       conn = sqlite3.connect(self.path)
+       try:
+           cursor = conn.cursor()
+           if write:
+               cursor.execute("BEGIN IMMEDIATE")
+           result = fn(cursor, *args)
+           conn.commit()
+           return result
+       finally:
+           conn.close()
+
+   async def read(self, fn, *args):
+       return await run_in_threadpool(self.run, fn, args, False)
+
+   async def write(self, fn, *args):
+       return await run_in_threadpool(self.run, fn, args, True)
+
+
+def parse_bulk_record(line):
+   # Returns a RegisterRequest, an error message for a bad line, or None for a blank line
+   if not line.strip():
+       return None
+   try:
+       return RegisterRequest(**json.loads(line))
+   except (ValueError, TypeError):
+       return "Invalid record."
+
+
+def iter_batches(records, batch_size=BULK_BATCH_SIZE):
+   records = iter(records)
+   batch = list(islice(records, batch_size))
+   while batch:
+       yield batch
+       batch = list(islice(records, batch_size))
+
+
+async def iter_async_batches(records, batch_size=BULK_BATCH_SIZE):
+   batch = []
+   async for record in records:
+       batch.append(record)
+       if len(batch) == batch_size:
+           yield batch
+           batch = []
+   if batch:
+       yield batch
+
+
+def find_conflicts(cursor, rows):
+   # Maps the index of every row that would violate a UNIQUE constraint, either against
+   # users already in the database or against an earlier row of the same batch, to its error
+   taken = {"username": set(), "email": set()}
+   for column in taken:
+       values = list({getattr(data, column) for _, data in rows})
+       for start in range(0, len(values), SQLITE_MAX_PARAMS):
+           chunk = values[start:start + SQLITE_MAX_PARAMS]
+           placeholders = ", ".join("?" * len(chunk))
+           cursor.execute(f"SELECT {column} FROM users WHERE {column} IN ({placeholders})", chunk)
+           taken[column].update(value for (value,) in cursor.fetchall())
+
+   conflicts = {}
+   for index, (_, data) in enumerate(rows):
+       if data.username in taken["username"]:
+           conflicts[index] = "Username already exists."
+       elif data.email in taken["email"]:
+           conflicts[index] = "Email already exists."
+       else:
+           taken["username"].add(data.username)
+           taken["email"].add(data.email)
+   return conflicts
+
+
+def insert_users(cursor, rows):
+   # Runs under the write lock, so re-checking here catches users another writer registered meanwhile
+   conflicts = find_conflicts(cursor, [(line, data) for line, data, _ in rows])
+   cursor.executemany(
+       """
+       INSERT INTO users (username, email, password_hash)
+       VALUES (?, ?, ?)
+       """,
+       [
+           (data.username, data.email, password_hash)
+           for index, (_, data, password_hash) in enumerate(rows) if index not in conflicts
+       ]
+   )
+   return conflicts
+
+
+def hash_all(executor, passwords, workers):
+   chunksize = max(1, len(passwords) // (workers * 4))
+   return list(executor.map(ph.hash, passwords, chunksize=chunksize))
+
+
+async def register_batch(batch, database, executor, workers=BULK_HASH_WORKERS):
+   """Registers a batch of (line, record) pairs in one write transaction, returning one result per pair."""
+   results = {}
+   rows = []
+   for line, record in batch:
+       if isinstance(record, RegisterRequest):
+           rows.append((line, record))
+       else:
+           results[line] = {"line": line, "error": record}
+
+   # Drop known conflicts before hashing so that re-imports don't pay for Argon2 on every row
+   conflicts = await database.read(find_conflicts, rows)
+   for index, (line, data) in enumerate(rows):
+       if index in conflicts:
+           results[line] = {"line": line, "username": data.username, "error": conflicts[index]}
+   candidates = [row for index, row in enumerate(rows) if index not in conflicts]
+   passwords = [str(uuid.uuid4()) for _ in candidates]
+   hashes = await run_in_threadpool(hash_all, executor, passwords, workers)
+
+   late_conflicts = await database.write(
+       insert_users, [(line, data, password_hash) for (line, data), password_hash in zip(candidates, hashes)]
+   )
+   for index, (line, data) in enumerate(candidates):
+       if index in late_conflicts:
+           results[line] = {"line": line, "username": data.username, "error": late_conflicts[index]}
+       else:
+           results[line] = {"line": line, "username": data.username, "password": passwords[index]}
+
+   return [results[line] for line, _ in batch]
+
+
+async def iter_request_lines(request: Request, max_length=MAX_LINE_LENGTH):
+   # Yields None in place of a line longer than max_length, whose bytes are dropped as they arrive
+   buffer = bytearray()
+   too_long = False
+   async for chunk in request.stream():
+       start = 0
+       while True:
+           end = chunk.find(b"\n", start)
+           if not too_long:
+               buffer += chunk[start:] if end == -1 else chunk[start:end]
+               if len(buffer) > max_length:
+                   too_long = True
+                   buffer.clear()
+           if end == -1:
+               break
+           yield None if too_long else bytes(buffer)
+           buffer.clear()
+           too_long = False
+           start = end + 1
+   if too_long or buffer:
+       yield None if too_long else bytes(buffer)
+
+
+async def iter_request_records(request: Request):
+   line_number = 0
+   async for line in iter_request_lines(request):
+       line_number += 1
+       record = "Invalid record." if line is None else parse_bulk_record(line)
+       if record is not None:
+           yield line_number, record
+
+
+async def stream_bulk_registration(request: Request, database, executor):
+   # Batches are registered as soon as enough lines have arrived, so results stream back during the upload
+   async for batch in iter_async_batches(iter_request_records(request)):
+       for result in await register_batch(batch, database, executor):
+           yield json.dumps(result) + "\n"
+
+
+class NDJSONStreamingResponse(StreamingResponse):
+   media_type = "application/x-ndjson"
+
+   async def __call__(self, scope, receive, send):
+       # StreamingResponse listens on receive() for a disconnect while streaming, which would
+       # swallow the request body chunks that stream_bulk_registration is still reading
+       await self.stream_response(send)
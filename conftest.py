@@ -0,0 +1,30 @@
+import os
+import pytest
+import common
+
+# The servers refuse to start without a master key
+os.environ.setdefault("NOT_MY_KEY", "test master key secret")
+
+
+@pytest.fixture
+def master_key_env(monkeypatch):
+    """Giving a test its own master key variables, reloading the real ones afterwards."""
+    for name in list(os.environ):
+        if common.MASTER_KEY_VARIABLE.fullmatch(name):
+            monkeypatch.delenv(name)
+    monkeypatch.setenv("NOT_MY_KEY", "first master key secret")
+    common.configure_master_keys()
+    yield monkeypatch
+    monkeypatch.undo()
+    common.configure_master_keys()
+
+
+@pytest.fixture
+def rotate_master_key(master_key_env):
+    """Adding the next master key version to the environment and reloading, as a restart after rotation does."""
+    def rotate():
+        new_version = common.MASTER_KEY_VERSION + 1
+        master_key_env.setenv(f"NOT_MY_KEY_V{new_version}", f"master key secret {new_version}")
+        common.configure_master_keys()
+        return new_version
+    return rotate
@@ -1,100 +1,89 @@
 import sqlite3
-import base64
 import uuid
 import time
-import os
+import logging
+import threading
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
-from collections import defaultdict
+from common import (
+   DB_FILE, KEY_EXPIRY_TIME, REWRAP_BATCH_SIZE, REWRAP_PAUSE, REWRAP_INTERVAL, RegisterRequest, AuthRequest,
+   BlockingDatabase, NDJSONStreamingResponse, create_schema, create_hash_executor, configure_master_keys,
+   check_master_keys, generate_encrypted_key, rate_limiter, rewrap_batch, stream_bulk_registration, ph
+)
+
+
+@asynccontextmanager
+async def lifespan(app):
+   global hash_executor
+   # Refusing to start without the master keys every stored key needs
+   configure_master_keys()
+   init_db()
+   hash_executor = create_hash_executor()
+   start_rewrap_thread()
+   yield
+   stop_rewrap_thread()
+   hash_executor.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+app.middleware("http")(rate_limiter)
+hash_executor = None
+rewrap_stop = threading.Event()
+rewrap_thread = None
+logger = logging.getLogger(__name__)
 
 
-DB_FILE = "totally_not_my_privateKeys.db"
-AES_KEY = base64.urlsafe_b64decode(os.getenv("NOT_MY_KEY", "MISSING_KEY" * 4))[:32]
-RATE_LIMIT = 10
-RATE_PERIOD = 1
-
-
-app = FastAPI()
-ph = PasswordHasher()
-rate_limit_tracker = defaultdict(list)
-
-
-def encrypt_data(data: bytes):
-   iv = os.urandom(16)
-   cipher = Cipher(algorithms.AES(AES_KEY), modes.CFB(iv), backend=default_backend())
-   encryptor = cipher.encryptor()
-   encrypted_data = encryptor.update(data) + encryptor.finalize()
-   return encrypted_data, iv
-
-
-class RegisterRequest(BaseModel):
-   username: str
-   email: str
-
-
-class AuthRequest(BaseModel):
-   username: str
-   password: str
+def init_db():
+   conn = sqlite3.connect(DB_FILE)
+   try:
+       cursor = conn.cursor()
+       create_schema(cursor)
+       conn.commit()
+       check_master_keys(cursor)
+   finally:
+       conn.close()
 
 
-def init_db():
+def rewrap_data_keys(batch_size=REWRAP_BATCH_SIZE):
+   """Re-wraps every data key held under an older master key, returning the number of rows rotated."""
+   rotated = 0
+   last_kid = 0
    conn = sqlite3.connect(DB_FILE)
-   cursor = conn.cursor()
-   cursor.execute("DROP TABLE IF EXISTS keys")
-   cursor.execute("""
-       CREATE TABLE keys (
-           kid INTEGER PRIMARY KEY AUTOINCREMENT,
-           private_key BLOB NOT NULL,
-           iv BLOB NOT NULL,
-           public_key TEXT NOT NULL
-       )
-   """)
-   cursor.execute("""
-       CREATE TABLE IF NOT EXISTS users(
-           id INTEGER PRIMARY KEY AUTOINCREMENT,
-           username TEXT NOT NULL UNIQUE,
-           password_hash TEXT NOT NULL,
-           email TEXT UNIQUE,
-           date_registered TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-           last_login TIMESTAMP
-       )
-   """)
-   cursor.execute("""
-       CREATE TABLE IF NOT EXISTS auth_logs(
-           id INTEGER PRIMARY KEY AUTOINCREMENT,
-           request_ip TEXT NOT NULL,
-           request_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-           user_id INTEGER,
-           FOREIGN KEY(user_id) REFERENCES users(id)
-       )
-   """)
-   conn.commit()
-   conn.close()
+   try:
+       while True:
+           last_kid, count = rewrap_batch(conn.cursor(), last_kid, batch_size)
+           conn.commit()
+           rotated += count
+           if last_kid is None:
+               break
+           time.sleep(REWRAP_PAUSE)  # Short batches with a pause keep the write lock free for requests
+   finally:
+       conn.close()
+   return rotated
 
 
-init_db()
+def rewrap_data_keys_periodically(stop):
+   while not stop.is_set():
+       try:
+           rewrap_data_keys()
+       except Exception:
+           # A locked database shouldn't end rotation for good; the next pass picks up where this one failed
+           logger.exception("Re-wrapping data keys failed")
+       stop.wait(REWRAP_INTERVAL)
 
 
-@app.middleware("http")
-async def rate_limiter(request: Request, call_next):
-   if request.url.path == "/auth":
-       ip = request.client.host
-       now = time.time()
-       rate_limit_tracker[ip] = [ts for ts in rate_limit_tracker[ip] if now - ts < RATE_PERIOD]
-       if len(rate_limit_tracker[ip]) >= RATE_LIMIT:
-           return JSONResponse(status_code=429, content={"detail": "Too Many Requests"})
-       rate_limit_tracker[ip].append(now)
+def start_rewrap_thread():
+   global rewrap_thread
+   rewrap_stop.clear()
+   rewrap_thread = threading.Thread(target=rewrap_data_keys_periodically, args=(rewrap_stop,), daemon=True)
+   rewrap_thread.start()
 
 
-   response = await call_next(request)
-   return response
+def stop_rewrap_thread():
+   rewrap_stop.set()
+   if rewrap_thread is not None:
+       rewrap_thread.join()
 
 
 @app.post("/register")
@@ -121,6 +110,11 @@ async def register_user(data: RegisterRequest):
    return {"password": password}
 
 
+@app.post("/register/bulk")
+async def register_users_bulk(request: Request):
+   return NDJSONStreamingResponse(stream_bulk_registration(request, BlockingDatabase(DB_FILE), hash_executor))
+
+
 @app.post("/auth")
 async def authenticate_user(request: Request, data: AuthRequest):
    conn = sqlite3.connect(DB_FILE)
@@ -160,23 +154,7 @@ async def authenticate_user(request: Request, data: AuthRequest):
 
 @app.post("/generate-key")
 async def generate_key():
-   key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
-
-
-   private_bytes = key.private_bytes(
-       encoding=serialization.Encoding.PEM,
-       format=serialization.PrivateFormat.PKCS8,
-       encryption_algorithm=serialization.NoEncryption()
-   )
-
-
-   public_bytes = key.public_key().public_bytes(
-       encoding=serialization.Encoding.PEM,
-       format=serialization.PublicFormat.SubjectPublicKeyInfo
-   )
-
-
-   encrypted_key, iv = encrypt_data(private_bytes)
+   row = generate_encrypted_key()
 
 
    conn = sqlite3.connect(DB_FILE)
@@ -184,10 +162,10 @@ async def generate_key():
        cursor = conn.cursor()
        cursor.execute(
            """
-           INSERT INTO keys (private_key, iv, public_key)
-           VALUES (?, ?, ?)
+           INSERT INTO keys (private_key, iv, wrapped_key, key_version, public_key, exp)
+           VALUES (?, ?, ?, ?, ?, ?)
            """,
-           (encrypted_key, iv, public_bytes.decode('utf-8'))
+           (*row, int(time.time()) + KEY_EXPIRY_TIME)
        )
        conn.commit()
    finally:
@@ -196,4 +174,5 @@ async def generate_key():
 
    return {"message": "Key generated and stored securely."}
 
+
 # To run the program: uvicorn project3:app --host 127.0.0.1 --port 8080 --reload
\ No newline at end of file
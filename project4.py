@@ -0,0 +1,334 @@
+import sqlite3
+import asyncio
+import base64
+import logging
+import threading
+import time
+import uuid
+import jwt
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request
+from cryptography.hazmat.primitives import serialization
+from argon2.exceptions import VerifyMismatchError
+import common
+from common import (
+   DB_FILE, KEY_EXPIRY_TIME, REWRAP_BATCH_SIZE, REWRAP_PAUSE, REWRAP_INTERVAL, RegisterRequest, AuthRequest,
+   NDJSONStreamingResponse, create_schema, create_hash_executor, configure_master_keys, check_master_keys,
+   decrypt_data, generate_encrypted_key, rate_limiter, rewrap_batch, stream_bulk_registration, ph
+)
+
+
+READER_THREADS = 8
+WRITE_BATCH_SIZE = 256
+BUSY_TIMEOUT = 5
+
+
+class AsyncDatabase:
+   """SQLite access that never blocks the event loop.
+
+   All writes are queued to a single writer task that owns the only write connection and
+   commits whatever has queued up in one transaction, each job inside its own savepoint so a
+   failing job doesn't roll back the others. Reads run concurrently on a pool of threads with
+   their own connections, which WAL mode lets proceed alongside the writer.
+
+   Anything else writing the same file, such as the bulk_register CLI or a project3 server,
+   still competes for SQLite's lock. The writer then waits up to BUSY_TIMEOUT to begin its
+   transaction, and if it still can't, every job in that group fails with "database is locked".
+
+   The threads and connections only exist between start() and close(), so it can be started again.
+   """
+
+   def __init__(self, path, readers=READER_THREADS):
+       self.path = path
+       self.readers = readers
+       self.reader_executor = None
+       self.writer_executor = None
+       self.local = None
+       self.reader_connections = []
+       self.writer_connection = None
+       self.queue = None
+       self.writer_task = None
+
+   def connect(self):
+       conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+       conn.execute("PRAGMA journal_mode=WAL")
+       conn.execute("PRAGMA synchronous=NORMAL")
+       return conn
+
+   async def start(self):
+       self.reader_executor = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="sqlite-reader")
+       self.writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+       self.local = threading.local()
+       self.reader_connections = []
+       loop = asyncio.get_running_loop()
+       self.writer_connection = await loop.run_in_executor(self.writer_executor, self.connect)
+       self.queue = asyncio.Queue()
+       self.writer_task = asyncio.create_task(self.run_writer())
+
+   async def close(self):
+       await self.queue.put(None)
+       await self.writer_task
+       loop = asyncio.get_running_loop()
+       await loop.run_in_executor(self.writer_executor, self.writer_connection.close)
+       self.writer_executor.shutdown()
+       self.reader_executor.shutdown()
+       for conn in self.reader_connections:
+           conn.close()
+
+   def run_read(self, fn, args):
+       conn = getattr(self.local, "conn", None)
+       if conn is None:
+           conn = self.local.conn = self.connect()
+           self.reader_connections.append(conn)
+       return fn(conn.cursor(), *args)
+
+   async def read(self, fn, *args):
+       """Runs fn(cursor, *args) on a reader connection."""
+       loop = asyncio.get_running_loop()
+       return await loop.run_in_executor(self.reader_executor, self.run_read, fn, args)
+
+   async def write(self, fn, *args):
+       """Queues fn(cursor, *args) for the writer task, returning its result once committed."""
+       future = asyncio.get_running_loop().create_future()
+       await self.queue.put((fn, args, future))
+       return await future
+
+   def run_jobs(self, jobs):
+       cursor = self.writer_connection.cursor()
+       outcomes = []
+       cursor.execute("BEGIN IMMEDIATE")
+       try:
+           for fn, args, _ in jobs:
+               cursor.execute("SAVEPOINT job")
+               try:
+                   outcomes.append((True, fn(cursor, *args)))
+                   cursor.execute("RELEASE job")
+               except Exception as e:
+                   cursor.execute("ROLLBACK TO job")
+                   cursor.execute("RELEASE job")
+                   outcomes.append((False, e))
+           cursor.execute("COMMIT")
+       except Exception:
+           if self.writer_connection.in_transaction:
+               cursor.execute("ROLLBACK")
+           raise
+       return outcomes
+
+   async def run_writer(self):
+       loop = asyncio.get_running_loop()
+       stopping = False
+       while not stopping:
+           jobs = [await self.queue.get()]
+           while len(jobs) < WRITE_BATCH_SIZE and not self.queue.empty():
+               jobs.append(self.queue.get_nowait())
+           if None in jobs:
+               stopping = True
+               jobs = [job for job in jobs if job is not None]
+           if not jobs:
+               continue
+
+           try:
+               outcomes = await loop.run_in_executor(self.writer_executor, self.run_jobs, jobs)
+           except Exception as e:
+               outcomes = [(False, e)] * len(jobs)
+           for (_, _, future), (ok, value) in zip(jobs, outcomes):
+               if future.cancelled():
+                   continue
+               if ok:
+                   future.set_result(value)
+               else:
+                   future.set_exception(value)
+
+
+db = AsyncDatabase(DB_FILE)
+hash_executor = None
+logger = logging.getLogger(__name__)
+
+
+async def run_in_process_pool(fn, *args):
+   # Argon2 is CPU-bound, so it runs on a process pool rather than the event loop
+   return await asyncio.get_running_loop().run_in_executor(hash_executor, fn, *args)
+
+
+def insert_key(cursor, row, exp):
+   cursor.execute(
+       """
+       INSERT INTO keys (private_key, iv, wrapped_key, key_version, public_key, exp)
+       VALUES (?, ?, ?, ?, ?, ?)
+       """,
+       (*row, exp)
+   )
+   return cursor.lastrowid
+
+
+async def store_new_key(exp):
+   row = await asyncio.to_thread(generate_encrypted_key)
+   return await db.write(insert_key, row, exp)
+
+
+@asynccontextmanager
+async def lifespan(app):
+   global hash_executor
+   configure_master_keys()
+   await db.start()
+   try:
+       await db.write(create_schema)
+       await db.read(check_master_keys)
+   except Exception:
+       await db.close()
+       raise
+   hash_executor = create_hash_executor()
+   # Ensuring we have at least one valid and one expired key
+   now = int(time.time())
+   await store_new_key(now - 10)
+   await store_new_key(now + KEY_EXPIRY_TIME)
+   rewrap_task = asyncio.create_task(rewrap_data_keys_periodically())
+   yield
+   rewrap_task.cancel()
+   await asyncio.gather(rewrap_task, return_exceptions=True)
+   await db.close()
+   hash_executor.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+app.middleware("http")(rate_limiter)
+
+
+async def rewrap_data_keys(database, batch_size=REWRAP_BATCH_SIZE):
+   """Re-wraps every data key held under an older master key through the writer, returning the number of rows rotated."""
+   rotated = 0
+   last_kid = 0
+   while True:
+       last_kid, count = await database.write(rewrap_batch, last_kid, batch_size)
+       rotated += count
+       if last_kid is None:
+           return rotated
+       await asyncio.sleep(REWRAP_PAUSE)
+
+
+async def rewrap_data_keys_periodically():
+   while True:
+       try:
+           await rewrap_data_keys(db)
+       except Exception:
+           logger.exception("Re-wrapping data keys failed")
+       await asyncio.sleep(REWRAP_INTERVAL)
+
+
+def insert_user(cursor, username, email, password_hash):
+   cursor.execute(
+       """
+       INSERT INTO users (username, email, password_hash)
+       VALUES (?, ?, ?)
+       """,
+       (username, email, password_hash)
+   )
+
+
+@app.post("/register")
+async def register_user(data: RegisterRequest):
+   password = str(uuid.uuid4())
+   hashed_password = await run_in_process_pool(ph.hash, password)
+   try:
+       await db.write(insert_user, data.username, data.email, hashed_password)
+   except sqlite3.IntegrityError:
+       raise HTTPException(status_code=400, detail="Username or Email already exists.")
+
+
+   return {"password": password}
+
+
+@app.post("/register/bulk")
+async def register_users_bulk(request: Request):
+   return NDJSONStreamingResponse(stream_bulk_registration(request, db, hash_executor))
+
+
+def select_user(cursor, username):
+   cursor.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,))
+   return cursor.fetchone()
+
+
+def insert_auth_log(cursor, request_ip, user_id):
+   cursor.execute(
+       """
+       INSERT INTO auth_logs (request_ip, user_id)
+       VALUES (?, ?)
+       """,
+       (request_ip, user_id)
+   )
+
+
+def select_signing_key(cursor, expired):
+   # Keys wrapped by a newer master key than ours come from an instance already on the next version
+   query = (
+       "SELECT kid, private_key, iv, wrapped_key, key_version, public_key FROM keys "
+       "WHERE exp {} ? AND key_version <= ? ORDER BY exp DESC LIMIT 1"
+   )
+   cursor.execute(query.format("<=" if expired else ">"), (int(time.time()), common.MASTER_KEY_VERSION))
+   return cursor.fetchone()
+
+
+def sign_token(key_row, subject, expired):
+   kid, private_key, iv, wrapped_key, key_version, public_key = key_row
+   private_pem = decrypt_data(private_key, iv, wrapped_key, key_version, public_key.encode())
+   now = int(time.time())
+   exp_time = now - 600 if expired else now + 600
+   return jwt.encode(
+       {"sub": subject, "exp": exp_time, "iat": now},
+       private_pem,
+       algorithm="RS256",
+       headers={"kid": str(kid)}
+   )
+
+
+@app.post("/auth")
+async def authenticate_user(request: Request, data: AuthRequest, expired: bool = Query(False)):
+   # project3's login, issuing a token for the user like project1/2 do; ?expired=true signs with an expired key
+   user = await db.read(select_user, data.username)
+   if not user:
+       raise HTTPException(status_code=401, detail="Invalid username or password.")
+
+
+   user_id, password_hash = user
+
+
+   try:
+       await run_in_process_pool(ph.verify, password_hash, data.password)
+   except VerifyMismatchError:
+       raise HTTPException(status_code=401, detail="Invalid username or password.")
+
+
+   await db.write(insert_auth_log, request.client.host, user_id)
+
+   key_row = await db.read(select_signing_key, expired)
+   if not key_row:
+       raise HTTPException(status_code=404, detail="No appropriate key found")
+   token = await asyncio.to_thread(sign_token, key_row, data.username, expired)
+   return {"message": "Authentication successful.", "token": token}
+
+
+@app.post("/generate-key")
+async def generate_key():
+   await store_new_key(int(time.time()) + KEY_EXPIRY_TIME)
+   return {"message": "Key generated and stored securely."}
+
+
+def public_key_to_jwk(public_key_pem, kid):
+   numbers = serialization.load_pem_public_key(public_key_pem.encode()).public_numbers()
+   n = base64.urlsafe_b64encode(numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, 'big')).decode().rstrip("=")
+   e = base64.urlsafe_b64encode(numbers.e.to_bytes((numbers.e.bit_length() + 7) // 8, 'big')).decode().rstrip("=")
+   return {"kty": "RSA", "kid": str(kid), "alg": "RS256", "use": "sig", "n": n, "e": e}
+
+
+def select_public_keys(cursor):
+   cursor.execute("SELECT kid, public_key FROM keys WHERE exp > ?", (int(time.time()),))
+   return cursor.fetchall()
+
+
+@app.get("/.well-known/jwks.json")
+async def get_jwks():
+   rows = await db.read(select_public_keys)
+   return {"keys": [public_key_to_jwk(public_key, kid) for kid, public_key in rows]}
+
+# To run the program: uvicorn project4:app --host 127.0.0.1 --port 8080
@@ -0,0 +1,137 @@
+import pytest
+import asyncio
+import sqlite3
+import uuid
+import json
+import jwt
+from fastapi.testclient import TestClient
+import common
+import project4
+from project4 import app, AsyncDatabase
+
+
+@pytest.fixture(scope="module")
+def client():
+    """Running the app with its lifespan so the database layer and startup keys are in place."""
+    with TestClient(app) as client:
+        yield client
+
+
+def register(client):
+    username = str(uuid.uuid4())
+    response = client.post("/register", json={"username": username, "email": f"{username}@example.com"})
+    assert response.status_code == 200
+    return username, response.json()["password"]
+
+
+def test_register_and_authenticate(client):
+    """Test registering a user, logging in and getting a token signed by a published key."""
+    username, password = register(client)
+
+    response = client.post("/auth", json={"username": username, "password": password})
+    assert response.status_code == 200
+    token = response.json()["token"]
+    assert jwt.decode(token, options={"verify_signature": False})["sub"] == username
+
+    kid = jwt.get_unverified_header(token)["kid"]
+    jwks = client.get("/.well-known/jwks.json").json()
+    assert kid in [key["kid"] for key in jwks["keys"]]
+
+def test_duplicate_register(client):
+    """Test duplicate user registration fails through the writer task."""
+    username, _ = register(client)
+    response = client.post("/register", json={"username": username, "email": "someone-else@example.com"})
+    assert response.status_code == 400
+
+def test_wrong_password(client):
+    """Test authentication with a wrong password fails."""
+    username, _ = register(client)
+    response = client.post("/auth", json={"username": username, "password": "wrong"})
+    assert response.status_code == 401
+
+def test_auth_requires_credentials(client):
+    """Test that no token is issued without credentials."""
+    response = client.post("/auth")
+    assert response.status_code == 422
+
+def test_auth_expired(client):
+    """Test logging in with ?expired=true gets a token signed by an unpublished, expired key."""
+    username, password = register(client)
+    response = client.post("/auth?expired=true", json={"username": username, "password": password})
+    assert response.status_code == 200
+    token = response.json()["token"]
+    kid = jwt.get_unverified_header(token)["kid"]
+    jwks = client.get("/.well-known/jwks.json").json()
+    assert kid not in [key["kid"] for key in jwks["keys"]]  # Expired keys are not published
+
+def test_bulk_register(client):
+    """Test bulk registration reports conflicts per row."""
+    username = str(uuid.uuid4())
+    body = "\n".join([
+        json.dumps({"username": username, "email": f"{username}@example.com"}),
+        json.dumps({"username": username, "email": "again@example.com"}),
+    ])
+    response = client.post("/register/bulk", content=body)
+    assert response.status_code == 200
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert "password" in results[0]
+    assert results[1]["error"] == "Username already exists."
+
+def test_jobs_in_a_group_are_isolated(tmp_path):
+    """Test that a failing job committed in the same transaction doesn't roll back the others."""
+    async def run():
+        database = AsyncDatabase(str(tmp_path / "test.db"))
+        await database.start()
+        await database.write(lambda cursor: cursor.execute("CREATE TABLE t (v INTEGER UNIQUE)"))
+
+        def insert(cursor, value):
+            cursor.execute("INSERT INTO t (v) VALUES (?)", (value,))
+
+        # One group, exactly as the writer task would hand it over
+        jobs = [(insert, (value,), None) for value in [1, 2, 2, 3]]
+        outcomes = await asyncio.get_running_loop().run_in_executor(database.writer_executor, database.run_jobs, jobs)
+        rows = await database.read(lambda cursor: cursor.execute("SELECT v FROM t ORDER BY v").fetchall())
+        await database.close()
+        return outcomes, rows
+
+    outcomes, rows = asyncio.run(run())
+    assert [ok for ok, _ in outcomes] == [True, True, False, True]
+    assert isinstance(outcomes[2][1], sqlite3.IntegrityError)
+    assert rows == [(1,), (2,), (3,)]
+
+def test_restart_keeps_keys_and_users(monkeypatch, tmp_path):
+    """Test that restarting the server keeps the keys and users it stored before."""
+    monkeypatch.setattr(project4, "db", AsyncDatabase(str(tmp_path / "restart.db")))
+    monkeypatch.setattr(project4, "hash_executor", project4.hash_executor)  # Restored for the module's client
+    with TestClient(app) as first_run:
+        username, password = register(first_run)
+        kids = {key["kid"] for key in first_run.get("/.well-known/jwks.json").json()["keys"]}
+
+    with TestClient(app) as second_run:
+        response = second_run.post("/auth", json={"username": username, "password": password})
+        assert response.status_code == 200
+        jwks = second_run.get("/.well-known/jwks.json").json()
+        assert kids < {key["kid"] for key in jwks["keys"]}
+
+def test_rewrap_goes_through_writer(monkeypatch, tmp_path, rotate_master_key):
+    """Test that key rotation runs as writer jobs on the AsyncDatabase."""
+    async def run():
+        database = AsyncDatabase(str(tmp_path / "rotation.db"))
+        await database.start()
+        await database.write(common.create_schema)
+        for _ in range(3):
+            await database.write(project4.insert_key, common.generate_encrypted_key(), 0)
+
+        new_version = rotate_master_key()
+        jobs = []
+        write = database.write
+        monkeypatch.setattr(database, "write", lambda fn, *args: jobs.append(fn) or write(fn, *args))
+        rotated = await project4.rewrap_data_keys(database, batch_size=2)
+        versions = await database.read(lambda cursor: cursor.execute("SELECT key_version FROM keys").fetchall())
+        await database.close()
+        return rotated, versions, jobs, new_version
+
+    rotated, versions, jobs, new_version = asyncio.run(run())
+    assert rotated == 3
+    assert versions == [(new_version,)] * 3
+    assert set(jobs) == {common.rewrap_batch}